@@ -22,6 +22,7 @@ Annotations:
   newlines: The number of newlines required before the node.
 """
 
+from yapf_third_party._ylib2to3 import pygram
 from yapf_third_party._ylib2to3.pgen2 import token as grammar_token
 
 from yapf.pytree import pytree_utils
@@ -32,6 +33,10 @@ _NO_BLANK_LINES = 1
 _ONE_BLANK_LINE = 2
 _TWO_BLANK_LINES = 3
 
+# Token numbers compared against on every simple_stmt and funcdef.
+_COMMENT = grammar_token.COMMENT
+_ASYNC = grammar_token.ASYNC
+
 _PYTHON_STATEMENTS = frozenset({
     'small_stmt', 'expr_stmt', 'print_stmt', 'del_stmt', 'pass_stmt',
     'break_stmt', 'continue_stmt', 'return_stmt', 'raise_stmt', 'yield_stmt',
@@ -40,6 +45,14 @@ _PYTHON_STATEMENTS = frozenset({
     'async_stmt', 'simple_stmt'
 })
 
+# Grammar symbol numbers of _PYTHON_STATEMENTS, so that visiting a node only
+# needs an integer membership test. Names that the grammar doesn't define
+# (e.g. 'nonlocal_stmt') can never match a node and are skipped.
+_PYTHON_STATEMENT_TYPES = frozenset(
+    pygram.python_grammar.symbol2number[name]
+    for name in _PYTHON_STATEMENTS
+    if name in pygram.python_grammar.symbol2number)
+
 
 def CalculateBlankLines(tree):
   """Run the blank line calculator visitor over the tree.
@@ -56,6 +69,23 @@ def CalculateBlankLines(tree):
 class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
   """_BlankLineCalculator - see file-level docstring for a description."""
 
+  # The visitor's state is read and written on every node it visits.
+  __slots__ = (
+      'class_level',
+      'function_level',
+      'last_comment_lineno',
+      'last_was_decorator',
+      'last_was_class_or_function',
+      '_prev_stmt',
+      '_top_level_blanks',
+      '_between_methods_blanks',
+      '_enclosing_func_cache',
+      '_enclosing_class_cache',
+      '_first_leaf_cache',
+      '_work_list',
+      '_visit_table',
+  )
+
   def __init__(self):
     self.class_level = 0
     self.function_level = 0
@@ -63,10 +93,51 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     self.last_was_decorator = False
     self.last_was_class_or_function = False
     self._prev_stmt = None
+    # The style can't change during a run, so look these up only once.
+    self._top_level_blanks = (
+        1 + style.Get('BLANK_LINES_AROUND_TOP_LEVEL_DEFINITION'))
+    # Keep at least one blank line as a floor (to avoid 0 if user misconfigures).
+    self._between_methods_blanks = max(
+        _ONE_BLANK_LINE, 1 + style.Get('BLANK_LINES_BETWEEN_CLASS_DEFS'))
+    # Ancestor lookups keyed by id(node); the tree is not restructured while
+    # we visit it, so these stay valid for the whole run.
+    self._enclosing_func_cache = {}
+    self._enclosing_class_cache = {}
+    self._first_leaf_cache = {}
+    # Pending (function, node) pairs. Visitors push a node's children here,
+    # along with a hook to run once they're done, instead of recursing.
+    self._work_list = []
+    # Map each token and grammar symbol number to the method that visits it,
+    # rather than looking 'Visit_' + NodeName(node) up on every node.
+    self._visit_table = {}
+    for type_num, name in grammar_token.tok_name.items():
+      self._visit_table[type_num] = getattr(self, 'Visit_' + name,
+                                            self.DefaultLeafVisit)
+    for type_num, name in pygram.python_grammar.number2symbol.items():
+      self._visit_table[type_num] = getattr(self, 'Visit_' + name,
+                                            self.DefaultNodeVisit)
+
+  def Visit(self, node):
+    """Visit a node and its descendants without recursing."""
+    work_list = self._work_list
+    base = len(work_list)
+    work_list.append((self._visit_table[node.type], node))
+    while len(work_list) > base:
+      func, arg = work_list.pop()
+      func(arg)
+
+  def _PushChildren(self, children):
+    work_list = self._work_list
+    visit_table = self._visit_table
+    for child in reversed(children):
+      work_list.append((visit_table[child.type], child))
 
   def Visit_simple_stmt(self, node):  # pylint: disable=invalid-name
+    self._work_list.append((self._LeaveSimpleStmt, node))
     self.DefaultNodeVisit(node)
-    if node.children[0].type == grammar_token.COMMENT:
+
+  def _LeaveSimpleStmt(self, node):
+    if node.children[0].type == _COMMENT:
       self.last_comment_lineno = node.children[0].lineno
     else:
       # Do NOT set _prev_stmt on pure comment lines; keep the last real stmt.
@@ -79,12 +150,14 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
       _SetNumNewlines(node.children[0], _NO_BLANK_LINES)
     elif self.last_was_decorator:
       _SetNumNewlines(node.children[0], _NO_BLANK_LINES)
-    elif func is not None and self._prev_stmt is not None and _MethodsInSameClass(self._prev_stmt, func):
-      _SetNumNewlines(node.children[0], max(_ONE_BLANK_LINE, 1 + style.Get('BLANK_LINES_BETWEEN_CLASS_DEFS')))
+    elif func is not None and self._prev_stmt is not None and self._MethodsInSameClass(self._prev_stmt, func):
+      _SetNumNewlines(node.children[0], self._between_methods_blanks)
     else:
       _SetNumNewlines(node.children[0], self._GetNumNewlines(node))
-    for child in node.children:
-      self.Visit(child)
+    self._work_list.append((self._LeaveDecorator, node))
+    self._PushChildren(node.children)
+
+  def _LeaveDecorator(self, node):
     self.last_was_decorator = True
 
   def Visit_classdef(self, node):  # pylint: disable=invalid-name
@@ -92,15 +165,16 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     self.last_was_decorator = False
     self.class_level += 1
-    for child in node.children[index:]:
-      self.Visit(child)
+    self._work_list.append((self._LeaveClassdef, node))
+    self._PushChildren(node.children[index:])
+
+  def _LeaveClassdef(self, node):
     self.class_level -= 1
     self.last_was_class_or_function = True
     self._prev_stmt = node
 
   def Visit_funcdef(self, node):  # pylint: disable=invalid-name
     self.last_was_class_or_function = False
-    index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     if _AsyncFunction(node):
       index = self._SetBlankLinesBetweenCommentAndClassFunc(
           node.prev_sibling.parent)
@@ -109,8 +183,10 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
       index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     self.last_was_decorator = False
     self.function_level += 1
-    for child in node.children[index:]:
-      self.Visit(child)
+    self._work_list.append((self._LeaveFuncdef, node))
+    self._PushChildren(node.children[index:])
+
+  def _LeaveFuncdef(self, node):
     self.function_level -= 1
     self.last_was_class_or_function = True
     self._prev_stmt = node
@@ -125,11 +201,11 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
       node: (pytree.Node) The node to visit.
     """
     if self.last_was_class_or_function:
-      if pytree_utils.NodeName(node) in _PYTHON_STATEMENTS:
-        leaf = pytree_utils.FirstLeafNode(node)
+      if node.type in _PYTHON_STATEMENT_TYPES:
+        leaf = self._FirstLeafNode(node)
         _SetNumNewlines(leaf, self._GetNumNewlines(leaf))
     self.last_was_class_or_function = False
-    super(_BlankLineCalculator, self).DefaultNodeVisit(node)
+    self._PushChildren(node.children)
 
   def _SetBlankLinesBetweenCommentAndClassFunc(self, node):
     """Set the number of blanks between a comment and class or func definition.
@@ -166,47 +242,62 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     if self.last_was_decorator:
       return _NO_BLANK_LINES
     elif self._IsTopLevel(node):
-      return 1 + style.Get('BLANK_LINES_AROUND_TOP_LEVEL_DEFINITION')
-    elif self._prev_stmt is not None and _MethodsInSameClass(self._prev_stmt, node):
+      return self._top_level_blanks
+    elif self._prev_stmt is not None and self._MethodsInSameClass(self._prev_stmt, node):
       # Only between consecutive methods *in the same class*.
-      # Keep at least one blank line as a floor (to avoid 0 if user misconfigures).
-      return max(_ONE_BLANK_LINE, 1 + style.Get('BLANK_LINES_BETWEEN_CLASS_DEFS'))
+      return self._between_methods_blanks
     return _NO_BLANK_LINES
 
   def _IsTopLevel(self, node):
     return (not (self.class_level or self.function_level) and
-            _StartsInZerothColumn(node))
+            self._StartsInZerothColumn(node))
 
+  def _StartsInZerothColumn(self, node):
+    return (self._FirstLeafNode(node).column == 0 or
+            (_AsyncFunction(node) and node.prev_sibling.column == 0))
 
-def _SetNumNewlines(node, num_newlines):
-  pytree_utils.SetNodeAnnotation(node, pytree_utils.Annotation.NEWLINES,
-                                 num_newlines)
+  def _FirstLeafNode(self, node):
+    key = id(node)
+    if key not in self._first_leaf_cache:
+      self._first_leaf_cache[key] = pytree_utils.FirstLeafNode(node)
+    return self._first_leaf_cache[key]
 
+  def _EnclosingFunc(self, node):
+    key = id(node)
+    if key not in self._enclosing_func_cache:
+      self._enclosing_func_cache[key] = pytree_utils.EnclosingFunc(node)
+    return self._enclosing_func_cache[key]
 
-def _StartsInZerothColumn(node):
-  return (pytree_utils.FirstLeafNode(node).column == 0 or
-          (_AsyncFunction(node) and node.prev_sibling.column == 0))
+  def _EnclosingClass(self, node):
+    key = id(node)
+    if key not in self._enclosing_class_cache:
+      self._enclosing_class_cache[key] = pytree_utils.EnclosingClass(node)
+    return self._enclosing_class_cache[key]
 
+  def _MethodsInSameClass(self, prev_node, curr_node):
+    # 1) Walk up from each node to find the nearest *enclosing function* (def …).
+    prev_func = self._EnclosingFunc(prev_node)
+    curr_func = self._EnclosingFunc(curr_node)
 
-def _AsyncFunction(node):
-  return (node.prev_sibling and node.prev_sibling.type == grammar_token.ASYNC)
+    # 2) If either enclosing thing is not actually a function definition, bail out.
+    if not (pytree_utils.IsFuncDef(prev_func) and pytree_utils.IsFuncDef(curr_func)):
+      return False
+
+    # 3) From each function, walk up to find the *enclosing class* (class …).
+    prev_cls = self._EnclosingClass(prev_func.parent)
+    curr_cls = self._EnclosingClass(curr_func.parent)
 
+    # 4) True only if both functions live inside a class, and it’s the *same class node*.
+    return prev_cls is not None and prev_cls is curr_cls
 
-def _MethodsInSameClass(prev_node, curr_node):
-  # 1) Walk up from each node to find the nearest *enclosing function* (def …).
-  prev_func = pytree_utils.EnclosingFunc(prev_node)
-  curr_func = pytree_utils.EnclosingFunc(curr_node)
 
-  # 2) If either enclosing thing is not actually a function definition, bail out.
-  if not (pytree_utils.IsFuncDef(prev_func) and pytree_utils.IsFuncDef(curr_func)):
-    return False
+def _SetNumNewlines(node, num_newlines):
+  pytree_utils.SetNodeAnnotation(node, pytree_utils.Annotation.NEWLINES,
+                                 num_newlines)
 
-  # 3) From each function, walk up to find the *enclosing class* (class …).
-  prev_cls = pytree_utils.EnclosingClass(prev_func.parent)
-  curr_cls = pytree_utils.EnclosingClass(curr_func.parent)
 
-  # 4) True only if both functions live inside a class, and it’s the *same class node*.
-  return prev_cls is not None and prev_cls is curr_cls
+def _AsyncFunction(node):
+  return (node.prev_sibling and node.prev_sibling.type == _ASYNC)
 
 
 def _DecoratedFuncdef(node):
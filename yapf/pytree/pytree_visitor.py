@@ -54,6 +54,9 @@ class PyTreeVisitor(object):
   that may have children - otherwise the children will not be visited.
   """
 
+  # Lets subclasses that define __slots__ do without an instance __dict__.
+  __slots__ = ()
+
   def Visit(self, node):
     """Visit a node."""
     method = 'Visit_{0}'.format(pytree_utils.NodeName(node))
@@ -202,6 +202,24 @@ class BasicBlankLineCalculatorTest(yapf_test_helper.YAPFTest):
     llines = yapf_test_helper.ParseAndUnwrap(code)
     self.assertCodeEqual(code, reformatter.Reformat(llines))
 
+  def testCommentBeforeAsyncFunction(self):
+    unformatted_code = textwrap.dedent("""\
+        import os
+        # Comment before the function.
+        async def foo():
+          pass
+    """)
+    expected_formatted_code = textwrap.dedent("""\
+        import os
+
+
+        # Comment before the function.
+        async def foo():
+          pass
+    """)
+    llines = yapf_test_helper.ParseAndUnwrap(unformatted_code)
+    self.assertCodeEqual(expected_formatted_code, reformatter.Reformat(llines))
+
   def testCommentsBeforeClassDefs(self):
     code = textwrap.dedent('''\
         """Test."""